@@ -1,24 +1,50 @@
 import asyncio
 import json
 import hashlib
+import itertools
+import mmap
 import os
 import threading
 import time
 import queue
-from typing import Dict, Any, Callable, Optional
-from dataclasses import dataclass
-from aiortc import RTCPeerConnection, RTCDataChannel, RTCConfiguration, RTCIceServer
+import struct
+from collections import deque
+from dataclasses import dataclass, asdict
+from aiortc import RTCPeerConnection, RTCConfiguration, RTCIceServer
 from aiortc.contrib.signaling import object_to_string, object_from_string
+from aiortc.sdp import SessionDescription
 import firebase_admin
 from firebase_admin import credentials, firestore
 import logging
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop does not support Windows; fall back to the stdlib event loop
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DEFAULT_CHUNK_SIZE = 16384
+DEFAULT_CHUNK_SIZE = 65536
+HASH_BLOCK_SIZE = 131072
+DOWNLOADS_DIR = "~/Downloads/Telekinesis"
 ICE_GATHERING_TIMEOUT = 10
-CHUNK_DELAY = 0.001
+BUFFERED_AMOUNT_LOW_THRESHOLD = 262144
+BUFFERED_AMOUNT_HIGH_WATER = 1048576
+ACK_INTERVAL_CHUNKS = 64
+MAX_UNACKED_CHUNKS = 256
+ACK_TIMEOUT = 30
+PROGRESS_INTERVAL = 0.1
+EVENT_QUEUE_SIZE = 256
+SSE_BATCH_DELAY = 0.02
+SSE_BATCH_MAX_EVENTS = 32
+SSE_SUBSCRIBER_QUEUE_SIZE = 256
 STUN_SERVERS = [
     "stun:stun.l.google.com:19302",
     "stun:stun1.l.google.com:19302", 
@@ -36,19 +62,99 @@ STUN_SERVERS = [
     "stun:stun.voipstunt.com",
     "stun:stun.voxgratia.org"
 ]
+# aiortc only reads the configuration, so every peer connection can share one
+RTC_CONFIGURATION = RTCConfiguration(iceServers=[RTCIceServer(urls=[url]) for url in STUN_SERVERS])
+
+# Every data channel message is binary and starts with a one byte type tag:
+#   MSG_CHUNK:         tag | u32 index | payload
+#   MSG_FILE_METADATA: tag | JSON FileMetadata fields
+#   MSG_FILE_COMPLETE: tag | JSON {"file_hash": ...}
+#   MSG_TEXT:          tag | UTF-8 text
+#   MSG_ACK:           tag | u32 transfer id | u32 number of contiguous chunks on disk
+#   MSG_ABORT:         tag | u32 transfer id the receiver has given up on
+MSG_CHUNK = 0x01
+MSG_FILE_METADATA = 0x03
+MSG_FILE_COMPLETE = 0x04
+MSG_TEXT = 0x05
+MSG_ACK = 0x06
+MSG_ABORT = 0x07
+CHUNK_HEADER = struct.Struct('>BI')
+ACK_HEADER = struct.Struct('>BII')
+ABORT_HEADER = struct.Struct('>BI')
 
 @dataclass
 class FileMetadata:
+    __slots__ = ('filename', 'size', 'chunk_size', 'total_chunks', 'file_hash', 'transfer_id', '_message')
+    
     filename: str
     size: int
     chunk_size: int
     total_chunks: int
     file_hash: str
+    # Echoed back in every ACK so a late ACK for one file never counts toward the next
+    transfer_id: int
+    
+    def to_message(self):
+        """Encoded MSG_FILE_METADATA frame, built once and reused for resends"""
+        message = getattr(self, '_message', None)
+        if message is None:
+            message = self._message = encode_control(MSG_FILE_METADATA, asdict(self))
+        return message
+
+def new_sha256():
+    # The hash is an integrity check, not a security boundary, so skip the FIPS
+    # gate; hashlib's OpenSSL backend picks up SHA-NI/ARMv8 SHA where available
+    return hashlib.new('sha256', usedforsecurity=False)
+
+def hash_file(f):
+    """SHA-256 hex digest of an open binary file, read from the start"""
+    f.seek(0)
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, new_sha256).hexdigest()
+    hasher = new_sha256()
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+def encode_control(tag, body):
+    """Frame a JSON control message behind its type tag"""
+    payload = orjson.dumps(body) if orjson else json.dumps(body).encode()
+    return bytes((tag,)) + payload
+
+def decode_control(message):
+    if orjson:
+        return orjson.loads(memoryview(message)[1:])
+    return json.loads(message[1:])
+
+def preallocate(f, size):
+    """Reserve size bytes for f up front so the filesystem can lay it out contiguously"""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by every filesystem (e.g. some network mounts)
+            pass
+    f.truncate(size)
+
+def claim_unique_path(file_path):
+    """Atomically create an empty file at file_path, or at name_N.ext if taken"""
+    name, ext = os.path.splitext(file_path)
+    for counter in itertools.count(1):
+        try:
+            os.close(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return file_path
+        except FileExistsError:
+            file_path = f"{name}_{counter}{ext}"
 
 class Events:
-    def __init__(self):
-        self.queue = queue.Queue()
-        self.lock = threading.Lock()
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = None
+        # asyncio.Queue binds to the loop it is created on (Python 3.9), so build it on
+        # the loop thread; call_soon_threadsafe callbacks run in order, so it exists
+        # before any event posted after this returns
+        loop.call_soon_threadsafe(self._create_queue)
     
     TYPES = {
         'offer_created': 'offer_created',
@@ -61,24 +167,62 @@ class Events:
         'message_received': 'message_received',
     }
     
+    def _create_queue(self):
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    
     def add_event(self, event_type, data):
-        with self.lock:
-            self.queue.put({'type': event_type, 'data': data})
+        event = {'type': event_type, 'data': data}
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self._put(event)
+        else:
+            self.loop.call_soon_threadsafe(self._put, event)
+    
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            # A newer progress tick is always on its way, so it is the one to lose
+            if event['type'] == 'progress':
+                return
+
+        # Anything else makes room by evicting the oldest progress tick, and only
+        # drops the oldest real event (a received file, message or answer) when
+        # the backlog holds nothing but those
+        backlog = []
+        while True:
+            try:
+                backlog.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        for i, queued in enumerate(backlog):
+            if queued['type'] == 'progress':
+                del backlog[i]
+                break
+        else:
+            del backlog[0]
+        backlog.append(event)
+        for queued in backlog:
+            self.queue.put_nowait(queued)
     
-    def get_event(self, timeout=1):
-        return self.queue.get(timeout=timeout)
+    async def get_event(self):
+        return await self.queue.get()
     
     def clear_queue(self):
-        with self.lock:
-            while not self.queue.empty():
-                try:
-                    self.queue.get_nowait()
-                except queue.Empty:
-                    break
+        # Called on the loop thread, like every other consumer of the queue
+        while True:
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
     
 
 class SignalingManager:
-    def __init__(self):
+    def __init__(self, loop):
         try :
             cred = credentials.Certificate("secrets/theater-4-friends-firebase-adminsdk-txcja-ae6a2eb7cf.json")
         except Exception as e:
@@ -94,10 +238,13 @@ class SignalingManager:
         self.room_name = None
         self.user_name = None
         self.listener = None
+        self.answer = None
+        self.loop = loop
 
     def set_offer(self, room_name, user_name, offer, events_instance):
         self.room_name = room_name
         self.user_name = user_name
+        self.answer = None
         
         self.room_ref = self.db.collection("rooms").document(room_name)
         self.room_ref.set({
@@ -112,9 +259,9 @@ class SignalingManager:
         self.room_name = room_name
         self.user_name = user_name
 
+        # The responder is recorded together with the answer in set_answer, so joining
+        # costs one read here and one write there
         self.room_ref = self.db.collection("rooms").document(room_name)
-        self.room_ref.update({"responder": user_name})
-        
         doc = self.room_ref.get()
         if doc.exists:
             return doc.to_dict().get("offer")
@@ -122,6 +269,9 @@ class SignalingManager:
         return None
     
     def get_answer(self):
+        # The room listener keeps the latest answer, which saves a server read
+        if self.answer:
+            return self.answer
         if not self.room_ref:
             return None
         doc = self.room_ref.get()
@@ -130,33 +280,44 @@ class SignalingManager:
         return None
 
     def set_answer(self,value):
-        self.room_ref.update({"answer": value})
+        self.room_ref.update({"responder": self.user_name, "answer": value})
     
     def _setup_room_listener(self, events_instance):
         def on_room_update(doc_snapshot, changes, read_time):
             for doc in doc_snapshot:
                 data = doc.to_dict()
-                if "answer" in data and data["answer"]:
-                    events_instance.add_event('answer_received', data["answer"])
-                    threading.Timer(0.1, lambda: self._cleanup_listener()).start() 
+                answer = data.get("answer")
+                # Snapshots can repeat before the listener is torn down; only report a new answer
+                if answer and answer != self.answer:
+                    self.answer = answer
+                    events_instance.add_event('answer_received', answer)
+                    # The watch cannot be closed from its own callback thread; hand it to the loop
+                    self.loop.call_soon_threadsafe(self._cleanup_listener) 
         
         if self.listener:
             self._cleanup_listener()
         self.listener = self.room_ref.on_snapshot(on_room_update)
     
     def _cleanup_listener(self):
-        if self.listener:
-            try:
-                self.listener.unsubscribe()
-            except:
-                pass
-            self.listener = None
+        # Runs on the loop; Watch.unsubscribe() can block for up to a second while the
+        # stream shuts down, so detach the listener here and close it on an executor thread
+        listener, self.listener = self.listener, None
+        if listener:
+            self.loop.run_in_executor(None, self._unsubscribe, listener)
+
+    @staticmethod
+    def _unsubscribe(listener):
+        try:
+            listener.unsubscribe()
+        except:
+            pass
 
     def _reset_signaling(self):
         self._cleanup_listener()
         self.room_ref = None
         self.room_name = None
         self.user_name = None
+        self.answer = None
 
 
 class WebRTCManager:
@@ -164,25 +325,46 @@ class WebRTCManager:
         self.pc = None
         self.data_channel = None
         self.is_initiator = False
-        self.signaling_manager = SignalingManager()
+        self.signaling_manager = SignalingManager(loop)
         self.events = events_instance
         self.loop = loop
         
-        self.file_chunks = {}
         self.current_file_metadata = None
+        self.incoming_file = None
+        self.incoming_file_path = None
+        self.received_mask = None
         self.received_chunks = 0
+        self.incoming_hasher = None
+        self.next_hash_index = 0
+        self.incoming_file_lock = threading.Lock()
+        self.pending_writes = set()
+        self.write_error = None
+        self.contiguous_chunks = 0
+        self.last_ack_chunks = 0
+        self.acked_chunks = 0
+        self.transfer_id = 0
+        self.aborted_transfer_id = 0
+        self._transfer_ids = itertools.count(1)
+        self._last_progress_time = 0.0
+        # Created on the networking loop once a connection or channel exists; under
+        # Python 3.9 an asyncio.Event made here would bind to this (caller's) thread's loop
+        self._buffer_low = None
+        self._ack_received = None
+        self._ice_complete = None
+        self._file_task = None
+        self._deferred_messages = deque()
         
     async def _create_offer(self, room_name, user_name):
         # Close existing connection if any
         if self.pc:
             await self.pc.close()
         
-        ice_servers = [RTCIceServer(urls=[url]) for url in STUN_SERVERS]
-        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
+        self.pc = RTCPeerConnection(RTC_CONFIGURATION)
         self._setup_pc_handlers()
         self.is_initiator = True
         
-        self.data_channel = self.pc.createDataChannel("file_transfer")
+        # Reliable, ordered delivery: the receiver hashes chunks in arrival order
+        self.data_channel = self.pc.createDataChannel("file_transfer", ordered=True, maxRetransmits=None)
         self._setup_datachannel_handlers()
         
         offer = await self.pc.createOffer()
@@ -198,8 +380,7 @@ class WebRTCManager:
         if self.pc:
             await self.pc.close()
         
-        ice_servers = [RTCIceServer(urls=[url]) for url in STUN_SERVERS]
-        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
+        self.pc = RTCPeerConnection(RTC_CONFIGURATION)
         self._setup_pc_handlers()
         
         offer_str = self.signaling_manager.get_offer(room_name, user_name)
@@ -233,96 +414,330 @@ class WebRTCManager:
             self.events.add_event('error', f'Failed to set answer: {str(e)}')
   
     async def _wait_for_ice_gathering(self):
-        for _ in range(ICE_GATHERING_TIMEOUT * 10):
-            if self.pc.iceGatheringState == "complete":
-                break
-            await asyncio.sleep(0.1)
+        if self.pc.iceGatheringState == "complete":
+            return
+        try:
+            await asyncio.wait_for(self._ice_complete.wait(), ICE_GATHERING_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("ICE gathering did not complete, continuing with gathered candidates")
 
     def _setup_pc_handlers(self):
-        @self.pc.on("connectionstatechange")
+        self._ice_complete = asyncio.Event()
+        # Handlers keep their own connection: a reset clears self.pc before close() fires them
+        pc = self.pc
+        
+        @pc.on("icegatheringstatechange")
+        def on_icegatheringstatechange():
+            if pc.iceGatheringState == "complete":
+                self._ice_complete.set()
+        
+        @pc.on("connectionstatechange")
         async def on_connectionstatechange():
-            self.events.add_event('connection_state_changed', self.pc.connectionState)
+            self.events.add_event('connection_state_changed', pc.connectionState)
         
-        @self.pc.on("datachannel")
+        @pc.on("datachannel")
         def on_datachannel(channel):
             self.data_channel = channel
             self._setup_datachannel_handlers()
     
     def _setup_datachannel_handlers(self):
+        self._buffer_low = asyncio.Event()
+        self._ack_received = asyncio.Event()
+        
         @self.data_channel.on("message")
         def on_message(message):
-            # Use the correct event loop
-            asyncio.run_coroutine_threadsafe(self._handle_message(message), self.loop)
-    
-    async def _handle_message(self, message):
-        if isinstance(message, str):
-            data = json.loads(message)
-            if data.get('type') == 'file_metadata':
-                self.current_file_metadata = FileMetadata(**data['metadata'])
-                self.file_chunks = {}
-                self.received_chunks = 0
-            elif data.get('type') == 'file_complete':
-                await self._assemble_file()
-            elif data.get('type') == 'text_message':
-                self.events.add_event('message_received', data['content'])
-        elif isinstance(message, bytes):
-            await self._handle_file_chunk(message)
-
-    async def _handle_file_chunk(self, chunk_data):
+            # aiortc emits on our loop, so handle the message inline; only opening and
+            # completing a file need to await, and anything after them waits its turn
+            if self._file_task:
+                self._deferred_messages.append(message)
+            else:
+                self._dispatch_message(message)
+        
+        @self.data_channel.on("bufferedamountlow")
+        def on_bufferedamountlow():
+            self._buffer_low.set()
+        
+        @self.data_channel.on("close")
+        def on_close():
+            # Wake up a sender blocked on backpressure so it can bail out
+            self._buffer_low.set()
+            self._ack_received.set()
+    
+    def _dispatch_message(self, message):
+        # This runs inside aiortc's SCTP receive path, where an exception would tear
+        # down the whole connection; a bad message is reported, and only costs the
+        # file in progress when it belonged to that file
+        try:
+            self._handle_message(message)
+        except Exception as e:
+            self.events.add_event('error', f'Failed to handle incoming message: {e}')
+            if message[0] in (MSG_FILE_METADATA, MSG_CHUNK):
+                self._abort_incoming_file()
+
+    def _handle_message(self, message):
+        if not isinstance(message, bytes) or not message:
+            return
+        
+        tag = message[0]
+        if tag == MSG_CHUNK:
+            self._handle_chunk_message(message)
+        elif tag == MSG_FILE_METADATA:
+            self._file_task = self.loop.create_task(self._open_file(FileMetadata(**decode_control(message))))
+        elif tag == MSG_FILE_COMPLETE:
+            self._file_task = self.loop.create_task(self._complete_file(decode_control(message).get('file_hash')))
+        elif tag == MSG_TEXT:
+            self.events.add_event('message_received', message[1:].decode())
+        elif tag == MSG_ACK:
+            _, transfer_id, acked_chunks = ACK_HEADER.unpack_from(message)
+            if transfer_id == self.transfer_id:
+                self.acked_chunks = max(self.acked_chunks, acked_chunks)
+                self._ack_received.set()
+        elif tag == MSG_ABORT:
+            _, transfer_id = ABORT_HEADER.unpack_from(message)
+            self.aborted_transfer_id = transfer_id
+            # Wake a sender blocked on either kind of backpressure so it can stop
+            self._ack_received.set()
+            self._buffer_low.set()
+
+    async def _open_file(self, metadata):
+        try:
+            await self._start_incoming_file(metadata)
+        except Exception as e:
+            self.events.add_event('error', f'Failed to receive {metadata.filename}: {e}')
+            self._abort_incoming_file()
+        finally:
+            self._replay_deferred_messages()
+
+    async def _start_incoming_file(self, metadata):
+        self._discard_incoming_file()
+        # The transfer is current from here on, so a failure below aborts it by id
+        self.current_file_metadata = metadata
+
+        # The name comes from the peer; keep only its last component, whichever
+        # separator the sender's platform uses, so it cannot escape DOWNLOADS_DIR
+        filename = os.path.basename(metadata.filename.replace('\\', '/'))
+        if filename in ('', '.', '..'):
+            raise ValueError(f'Invalid file name: {metadata.filename!r}')
+        metadata.filename = filename
+
+        downloads_dir = os.path.expanduser(DOWNLOADS_DIR)
+        file_path = os.path.join(downloads_dir, f".{metadata.filename}.part")
+        # Without fallocate(2), glibc preallocates by writing every block, so this can
+        # take seconds on large files; run it on the executor like the chunk writes
+        opening = self.loop.run_in_executor(None, self._create_part_file, file_path, metadata.size)
+        try:
+            self.incoming_file = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # Reset while opening: the file still appears, so remove it once it does
+            opening.add_done_callback(lambda f: self._remove_part_file(f, file_path))
+            raise
+        self.incoming_file_path = file_path
+        self.pending_writes = set()
+        self.write_error = None
+        
+        self.received_mask = bytearray((metadata.total_chunks + 7) // 8)
+        self.received_chunks = 0
+        self.incoming_hasher = new_sha256()
+        self.next_hash_index = 0
+        self.contiguous_chunks = 0
+        self.last_ack_chunks = 0
+
+    @staticmethod
+    def _create_part_file(file_path, size):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        f = open(file_path, 'w+b')
+        try:
+            preallocate(f, size)
+        except BaseException:
+            f.close()
+            os.remove(file_path)
+            raise
+        return f
+
+    @staticmethod
+    def _remove_part_file(opening, file_path):
+        if not opening.exception():
+            opening.result().close()
+            os.remove(file_path)
+
+    def _abort_incoming_file(self):
+        # Tell the sender this transfer is dead; otherwise it waits on ACKs that never come
+        metadata = self.current_file_metadata
+        if metadata and self.data_channel and self.data_channel.readyState == "open":
+            self.data_channel.send(ABORT_HEADER.pack(MSG_ABORT, metadata.transfer_id))
+        self._discard_incoming_file()
+
+    def _discard_incoming_file(self):
+        if self.incoming_file:
+            with self.incoming_file_lock:
+                self.incoming_file.close()
+        if self.incoming_file_path and os.path.exists(self.incoming_file_path):
+            os.remove(self.incoming_file_path)
+        self.incoming_file = None
+        self.incoming_file_path = None
+        self.current_file_metadata = None
+        self.received_mask = None
+        self.received_chunks = 0
+        self.incoming_hasher = None
+        self.next_hash_index = 0
+        self.contiguous_chunks = 0
+        self.last_ack_chunks = 0
+        self.pending_writes = set()
+        self.write_error = None
+
+    def _handle_chunk_message(self, message):
         if not self.current_file_metadata:
             return
         
-        chunk_index = int.from_bytes(chunk_data[:4], byteorder='big')
-        chunk_content = chunk_data[4:]
-        self.file_chunks[chunk_index] = chunk_content
-        self.received_chunks += 1
+        # The payload is handed on as a view into the message, never copied
+        _, chunk_index = CHUNK_HEADER.unpack_from(message)
+        self._write_chunk(chunk_index, memoryview(message)[CHUNK_HEADER.size:])
         
-        progress = (self.received_chunks / self.current_file_metadata.total_chunks) * 100
-        self.events.add_event('progress', {'progress': progress, 'is_sending': False})   
-    
-    async def _assemble_file(self):
-        if not self.current_file_metadata or not self.file_chunks:
+        self._report_progress(self.received_chunks, self.current_file_metadata.total_chunks, False)
+
+    def _write_chunk(self, chunk_index, chunk_content):
+        if chunk_index >= self.current_file_metadata.total_chunks:
             return
         
-        file_data = b''
-        for i in range(self.current_file_metadata.total_chunks):
-            if i not in self.file_chunks:
+        # Disk writes run on the default executor so a slow disk never stalls the
+        # loop; _assemble_file waits for whatever is still in flight
+        write = self.loop.run_in_executor(
+            None, self._write_at, self.incoming_file,
+            chunk_index * self.current_file_metadata.chunk_size, chunk_content)
+        self.pending_writes.add(write)
+        write.add_done_callback(self._on_write_done)
+        
+        # The channel is ordered, so the hash can follow the chunks as they
+        # arrive; anything unexpected falls back to hashing the file at the end
+        if self.incoming_hasher and chunk_index == self.next_hash_index:
+            self.incoming_hasher.update(chunk_content)
+            self.next_hash_index += 1
+        else:
+            self.incoming_hasher = None
+        
+        if not self._is_received(chunk_index):
+            self.received_mask[chunk_index >> 3] |= 1 << (chunk_index & 7)
+            self.received_chunks += 1
+
+    def _send_ack(self):
+        # Let the sender know how far we have consumed, once per window. Chunks only
+        # count once their disk write has finished, so a slow disk slows the sender
+        metadata = self.current_file_metadata
+        if not metadata:
+            return
+        total_chunks = metadata.total_chunks
+        while self.contiguous_chunks < total_chunks and self._is_received(self.contiguous_chunks):
+            self.contiguous_chunks += 1
+        consumed = self.contiguous_chunks - len(self.pending_writes)
+        
+        if (consumed >= self.last_ack_chunks + ACK_INTERVAL_CHUNKS
+                or (consumed == total_chunks and self.last_ack_chunks != total_chunks)):
+            self.last_ack_chunks = consumed
+            if self.data_channel and self.data_channel.readyState == "open":
+                self.data_channel.send(ACK_HEADER.pack(MSG_ACK, metadata.transfer_id, consumed))
+
+    def _is_received(self, chunk_index):
+        return self.received_mask[chunk_index >> 3] & (1 << (chunk_index & 7))
+    
+    def _on_write_done(self, write):
+        self.pending_writes.discard(write)
+        if not write.cancelled() and write.exception():
+            self.write_error = write.exception()
+        self._send_ack()
+
+    def _write_at(self, f, offset, data):
+        with self.incoming_file_lock:
+            if f.closed:
                 return
-            file_data += self.file_chunks[i]
+            f.seek(offset)
+            f.write(data)
+    
+    async def _complete_file(self, file_hash):
+        try:
+            await self._assemble_file(file_hash)
+        except Exception as e:
+            self.events.add_event('error', f'Failed to save received file: {e}')
+            self._abort_incoming_file()
+        finally:
+            self._replay_deferred_messages()
+
+    def _replay_deferred_messages(self):
+        self._file_task = None
+        while self._deferred_messages and not self._file_task:
+            self._dispatch_message(self._deferred_messages.popleft())
+
+    async def _assemble_file(self, file_hash=None):
+        if not self.current_file_metadata or not self.incoming_file:
+            return
         
-        file_hash = hashlib.sha256(file_data).hexdigest()
-        if file_hash != self.current_file_metadata.file_hash:
+        metadata = self.current_file_metadata
+        if self.pending_writes:
+            await asyncio.wait(self.pending_writes)
+        if self.write_error:
+            self.events.add_event('error', f'Failed to write {metadata.filename}: {self.write_error}')
+            self._abort_incoming_file()
             return
         
-        downloads_dir = os.path.expanduser("~/Downloads/Telekinesis")
-        os.makedirs(downloads_dir, exist_ok=True)
-        file_path = os.path.join(downloads_dir, self.current_file_metadata.filename)
+        if self.received_chunks != metadata.total_chunks:
+            self.events.add_event('error', f'Incomplete file received: {metadata.filename}')
+            self._abort_incoming_file()
+            return
         
-        counter = 1
-        original_path = file_path
-        while os.path.exists(file_path):
-            name, ext = os.path.splitext(original_path)
-            file_path = f"{name}_{counter}{ext}"
-            counter += 1
+        expected_hash = file_hash or metadata.file_hash
+        if self.incoming_hasher:
+            received_hash = self.incoming_hasher.hexdigest()
+        else:
+            self.incoming_file.flush()
+            received_hash = await asyncio.to_thread(hash_file, self.incoming_file)
+        if received_hash != expected_hash:
+            self.events.add_event('error', f'Hash mismatch for received file: {metadata.filename}')
+            self._abort_incoming_file()
+            return
+        self.incoming_file.close()
+        self.incoming_file = None
         
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+        downloads_dir = os.path.expanduser(DOWNLOADS_DIR)
+        file_path = claim_unique_path(os.path.join(downloads_dir, metadata.filename))
+        os.replace(self.incoming_file_path, file_path)
+        self.incoming_file_path = None
         
         self.events.add_event('file_received', {
             'path': file_path,
-            'filename': self.current_file_metadata.filename
+            'filename': metadata.filename
         })
         
-        self.file_chunks = {}
-        self.current_file_metadata = None
-        self.received_chunks = 0
+        self._discard_incoming_file()
     
     async def _send_message(self, message):
         if self.data_channel and self.data_channel.readyState == "open":
-            msg = {'type': 'text_message', 'content': message}
-            self.data_channel.send(json.dumps(msg))
+            self.data_channel.send(bytes((MSG_TEXT,)) + message.encode())
+
+    def _report_progress(self, done_chunks, total_chunks, is_sending):
+        # At most one progress event per PROGRESS_INTERVAL, but always report completion
+        now = time.monotonic()
+        if done_chunks < total_chunks and now - self._last_progress_time < PROGRESS_INTERVAL:
+            return
+        self._last_progress_time = now
+        progress = (done_chunks / total_chunks) * 100
+        self.events.add_event('progress', {'progress': progress, 'is_sending': is_sending})
 
-    async def _send_file(self, file_path):
+    def _get_max_message_size(self):
+        # The largest message the remote accepts, from the a=max-message-size line in its
+        # SDP; aiortc does not enforce it on send, so the sender has to
+        max_message_size = DEFAULT_CHUNK_SIZE
+        if self.pc and self.pc.remoteDescription:
+            description = SessionDescription.parse(self.pc.remoteDescription.sdp)
+            for media in description.media:
+                if media.kind == 'application' and media.sctpCapabilities:
+                    max_message_size = media.sctpCapabilities.maxMessageSize
+        # Zero means the remote accepts messages of any size
+        return max_message_size or DEFAULT_CHUNK_SIZE
+
+    def _get_chunk_size(self):
+        # Every chunk goes out as header + payload in one message
+        return min(DEFAULT_CHUNK_SIZE, self._get_max_message_size()) - CHUNK_HEADER.size
+
+    async def _send_file(self, file_path, file_hash=None):
         if not self.data_channel or self.data_channel.readyState != "open":
             self.events.add_event('error', 'Data channel not ready for file transfer')
             return
@@ -331,53 +746,112 @@ class WebRTCManager:
             self.events.add_event('error', f'File not found: {file_path}')
             return
         
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
+        file_map, file_size = await asyncio.to_thread(self._map_file, file_path)
+        
+        try:
+            await self._send_file_data(os.path.basename(file_path), file_map or b'', file_size, file_hash)
+        finally:
+            if file_map:
+                file_map.close()
         
-        filename = os.path.basename(file_path)
-        file_size = len(file_data)
-        chunk_size = DEFAULT_CHUNK_SIZE
+        # A failed send has already been reported; the spooled upload goes either way
+        if 'temp' in file_path:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _map_file(file_path):
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            # mmap refuses to map empty files
+            file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else None
+        if file_map and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
+        return file_map, file_size
+
+    async def _send_file_data(self, filename, file_data, file_size, file_hash=None):
+        chunk_size = self._get_chunk_size()
         total_chunks = (file_size + chunk_size - 1) // chunk_size
-        file_hash = hashlib.sha256(file_data).hexdigest()
-        
-        metadata = {
-            'type': 'file_metadata',
-            'metadata': {
-                'filename': filename,
-                'size': file_size,
-                'chunk_size': chunk_size,
-                'total_chunks': total_chunks,
-                'file_hash': file_hash
-            }
-        }
-        self.data_channel.send(json.dumps(metadata))
-        
-        for i in range(total_chunks):
-            start = i * chunk_size
-            end = min(start + chunk_size, file_size)
-            chunk = file_data[start:end]
-            chunk_with_index = i.to_bytes(4, byteorder='big') + chunk
-            self.data_channel.send(chunk_with_index)
-            
-            progress = ((i + 1) / total_chunks) * 100
-            self.events.add_event('progress', {'progress': progress, 'is_sending': True})
-            await asyncio.sleep(CHUNK_DELAY)
         
-        self.data_channel.send(json.dumps({'type': 'file_complete'}))
+        metadata = FileMetadata(
+            filename=filename,
+            size=file_size,
+            chunk_size=chunk_size,
+            total_chunks=total_chunks,
+            file_hash=file_hash or '',
+            transfer_id=next(self._transfer_ids)
+        )
+        # Bind the hot-loop lookups once; this also keeps the loop on the channel it
+        # started with if the connection is reset underneath it
+        data_channel = self.data_channel
+        send = data_channel.send
+        pack_header = CHUNK_HEADER.pack
         
-        if 'temp' in file_path and os.path.exists(file_path):
-            os.remove(file_path)
+        self.transfer_id = metadata.transfer_id
+        self.acked_chunks = 0
+        data_channel.bufferedAmountLowThreshold = BUFFERED_AMOUNT_LOW_THRESHOLD
+        send(metadata.to_message())
+        
+        # The digest follows in file_complete, so unless the caller already knows it,
+        # hash in the same pass that sends
+        hasher = None if file_hash else new_sha256()
+        with memoryview(file_data) as view:
+            for i in range(total_chunks):
+                start = i * chunk_size
+                # Slicing the view is free; the only copy is the join into the outgoing message
+                chunk = view[start:start + chunk_size]
+                if hasher:
+                    hasher.update(chunk)
+                send(b''.join((pack_header(MSG_CHUNK, i), chunk)))
+                
+                self._report_progress(i + 1, total_chunks, True)
+                
+                # Only yield when the SCTP send buffer is actually full
+                if data_channel.bufferedAmount > BUFFERED_AMOUNT_HIGH_WATER:
+                    self._buffer_low.clear()
+                    await self._buffer_low.wait()
+                    if data_channel.readyState != "open":
+                        self.events.add_event('error', 'Data channel closed during file transfer')
+                        return False
+                
+                # Don't run further ahead of the receiver than its acknowledged window
+                while (i + 1 - self.acked_chunks > MAX_UNACKED_CHUNKS
+                        and self.aborted_transfer_id != metadata.transfer_id):
+                    self._ack_received.clear()
+                    try:
+                        await asyncio.wait_for(self._ack_received.wait(), ACK_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        self.events.add_event('error', f'Receiver stopped acknowledging {filename}')
+                        return False
+                    if data_channel.readyState != "open":
+                        self.events.add_event('error', 'Data channel closed during file transfer')
+                        return False
+                
+                if self.aborted_transfer_id == metadata.transfer_id:
+                    self.events.add_event('error', f'Receiver aborted the transfer of {filename}')
+                    return False
+        
+        send(encode_control(MSG_FILE_COMPLETE, {'file_hash': file_hash or hasher.hexdigest()}))
+        return True
 
-    def _reset(self):
-        if self.pc:
-            asyncio.run_coroutine_threadsafe(self.pc.close(), self.loop)
+    async def _reset(self):
+        # Runs on the loop, so nothing below races chunk writes, file opening or assembly
+        pc = self.pc
+        if self._file_task:
+            # A task cancelled before its first step never reaches its finally, so
+            # clear it here or every later message would be deferred behind it
+            self._file_task.cancel()
+            self._file_task = None
         self.pc = None
         self.data_channel = None
         self.is_initiator = False
         self.signaling_manager._reset_signaling()
-        self.file_chunks = {}
-        self.current_file_metadata = None
-        self.received_chunks = 0
+        self._deferred_messages.clear()
+        self._discard_incoming_file()
+        if pc:
+            await pc.close()
     
     def get_status(self):
         if self.pc:
@@ -398,40 +872,41 @@ class NetworkingManager:
     def __init__(self):
         self._loop = None
         self._loop_thread = None
-        self.events = Events()
         self._start_event_loop()
+        self.events = Events(self._loop)
         self._start_event_processor()
         self.web_rtc_manager = WebRTCManager(self.events, self._loop)
     
     def _start_event_loop(self):
+        # Create the loop up front so it is usable as soon as this returns;
+        # coroutines submitted before run_forever starts simply queue up
+        loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        self._loop = loop
+        
         def start_loop():
-            self._loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self._loop)
-            self._loop.run_forever()
+            asyncio.set_event_loop(loop)
+            loop.run_forever()
         
         self._loop_thread = threading.Thread(target=start_loop, daemon=True)
         self._loop_thread.start()
-        time.sleep(0.1)
         
     def _start_event_processor(self):
-        def process_events():
-            while True:
-                try:
-                    event = self.events.get_event(timeout=1)
-                    self._handle_event(event)
-                except queue.Empty:
-                    continue
-                except Exception as e:
-                    logger.error(f"Event processing error: {e}")
-        
-        threading.Thread(target=process_events, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._process_events(), self._loop)
+    
+    async def _process_events(self):
+        while True:
+            event = await self.events.get_event()
+            try:
+                self._handle_event(event)
+            except Exception as e:
+                logger.error(f"Event processing error: {e}")
 
     def _handle_event(self, event):
         event_type = event['type']
         data = event['data']
         
         if event_type == 'answer_received':
-            asyncio.run_coroutine_threadsafe(self.web_rtc_manager._set_answer(data), self._loop)
+            self._loop.create_task(self.web_rtc_manager._set_answer(data))
         elif event_type == 'offer_created':
             logger.info(f"Offer created")
         elif event_type == 'answer_created':
@@ -446,7 +921,7 @@ class NetworkingManager:
             logger.error(f"Error: {data}")
         elif event_type == 'progress':
             if isinstance(data, dict) and 'progress' in data:
-                logger.info(f"Progress: {data['progress']}% ({'sending' if data.get('is_sending') else 'receiving'})")
+                logger.debug("Progress: %s%% (%s)", data['progress'], 'sending' if data.get('is_sending') else 'receiving')
         
         SSEManager.sse_callback(event_type, data)
     
@@ -457,20 +932,29 @@ class NetworkingManager:
     def join_room(self, room_name, user_name):
         asyncio.run_coroutine_threadsafe(self.web_rtc_manager._create_answer(room_name, user_name), self._loop)
                
-    def send_file(self, file_path):
-        asyncio.run_coroutine_threadsafe(self.web_rtc_manager._send_file(file_path), self._loop)
+    def send_file(self, file_path, file_hash=None):
+        asyncio.run_coroutine_threadsafe(self.web_rtc_manager._send_file(file_path, file_hash), self._loop)
     
     def send_message(self, message):
         asyncio.run_coroutine_threadsafe(self.web_rtc_manager._send_message(message), self._loop)
     
-    def disconnect(self):
-        if self.web_rtc_manager.pc:
-            asyncio.run_coroutine_threadsafe(self.web_rtc_manager.pc.close(), self._loop)
-        self.web_rtc_manager._reset()
+    def reset(self):
+        # Drop the connection but keep the loop, signaling client and queues for reuse.
+        # The loop keeps handling chunks, assembly and SSE flushes against this state,
+        # so the teardown runs there rather than on the calling thread
+        asyncio.run_coroutine_threadsafe(self._reset(), self._loop).result()
+    
+    async def _reset(self):
+        await self.web_rtc_manager._reset()
         self.events.clear_queue()
         SSEManager.reset_sse_queue()
+    
+    def disconnect(self):
+        self.reset()
         if self._loop and not self._loop.is_closed():
             self._loop.call_soon_threadsafe(self._loop.stop)
+            if self._loop_thread and self._loop_thread is not threading.current_thread():
+                self._loop_thread.join(timeout=1)
     
     def get_status(self):
         return self.web_rtc_manager.get_status()
@@ -482,8 +966,26 @@ class NetworkingManager:
         return events
 
 class SSEManager:
-    event_queue = queue.Queue()
-    event_queue_lock = threading.Lock()
+    # Every connected SSE client gets its own bounded queue, so clients never take
+    # each other's events and a stalled one cannot grow without limit
+    subscribers = []
+    subscribers_lock = threading.Lock()
+    # Events are coalesced on the networking loop and handed to SSE clients as batches
+    pending_events = []
+    flush_handle = None
+    
+    @staticmethod
+    def subscribe():
+        subscriber = queue.Queue(maxsize=SSE_SUBSCRIBER_QUEUE_SIZE)
+        with SSEManager.subscribers_lock:
+            SSEManager.subscribers.append(subscriber)
+        return subscriber
+    
+    @staticmethod
+    def unsubscribe(subscriber):
+        with SSEManager.subscribers_lock:
+            if subscriber in SSEManager.subscribers:
+                SSEManager.subscribers.remove(subscriber)
     
     @staticmethod
     def sse_callback(event_type, data):
@@ -492,14 +994,51 @@ class SSEManager:
             'data': data, 
             'timestamp': time.time()
         }
-        logger.info(f"📤 Queuing SSE event: {event}")
-        SSEManager.event_queue.put(event)
+        logger.debug("Queuing SSE event: %s", event_type)
+        pending = SSEManager.pending_events
+        if event_type == 'progress' and pending and pending[-1]['type'] == 'progress':
+            # Only the latest tick matters to the client
+            pending[-1] = event
+        else:
+            pending.append(event)
+        
+        if len(pending) >= SSE_BATCH_MAX_EVENTS:
+            SSEManager.flush_events()
+        elif SSEManager.flush_handle is None:
+            SSEManager.flush_handle = asyncio.get_running_loop().call_later(SSE_BATCH_DELAY, SSEManager.flush_events)
+    
+    @staticmethod
+    def flush_events():
+        if SSEManager.flush_handle is not None:
+            SSEManager.flush_handle.cancel()
+            SSEManager.flush_handle = None
+        events, SSEManager.pending_events = SSEManager.pending_events, []
+        if not events:
+            return
+        
+        batch = {'type': 'batch', 'events': events, 'timestamp': time.time()}
+        with SSEManager.subscribers_lock:
+            subscribers = list(SSEManager.subscribers)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(batch)
+                    break
+                except queue.Full:
+                    # A client this far behind loses its oldest batch
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
 
     @staticmethod
     def reset_sse_queue():
-        with SSEManager.event_queue_lock:
-            while not SSEManager.event_queue.empty():
+        SSEManager.pending_events = []
+        with SSEManager.subscribers_lock:
+            subscribers = list(SSEManager.subscribers)
+        for subscriber in subscribers:
+            while True:
                 try:
-                    SSEManager.event_queue.get_nowait()
+                    subscriber.get_nowait()
                 except queue.Empty:
-                    break
\ No newline at end of file
+                    break
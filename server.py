@@ -3,29 +3,109 @@ Flask Server for WebRTC File Transfer Application
 Serves the web interface and handles WebRTC connection management
 """
 
-from flask import Flask, render_template, request, jsonify, send_from_directory, Response
+from flask import Flask, Request, request, jsonify, send_from_directory, Response
+from flask.json.provider import DefaultJSONProvider
 import os
 import logging
 import argparse
+import functools
+import gzip
 import queue
 import time
 import json
-from threading import Lock
-from networking import NetworkingManager, SSEManager
+import tempfile
+from networking import NetworkingManager, SSEManager, new_sha256
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Asset URLs are not fingerprinted, so keep this short enough for updates to reach clients
+STATIC_MAX_AGE = 3600
+TEMP_DIR = os.path.join(os.getcwd(), 'temp')
+os.makedirs(TEMP_DIR, exist_ok=True)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serve jsonify responses and request bodies through orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class HashingSpool:
+    """Spool file that hashes everything written to it on the way to disk"""
+    def __init__(self, file):
+        self.file = file
+        self.hasher = new_sha256()
+    
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class UploadRequest(Request):
+    """Spool multipart file parts straight into TEMP_DIR instead of memory or /tmp"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile('w+b', dir=TEMP_DIR, prefix='.upload-', delete=False)
+        spool = HashingSpool(stream)
+        self.spooled_files = getattr(self, 'spooled_files', []) + [spool]
+        return spool
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
+app.request_class = UploadRequest
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+if orjson:
+    app.json = ORJSONProvider(app)
 
 networking_manager = NetworkingManager()
 
+def sse_frame(payload):
+    if orjson:
+        return b"data: " + orjson.dumps(payload) + b"\n\n"
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+@app.teardown_request
+def remove_spooled_uploads(error=None):
+    # Parts that no handler moved into place would otherwise pile up in TEMP_DIR
+    for spool in getattr(request, 'spooled_files', ()):
+        # Windows refuses to remove a file that is still open
+        spool.close()
+        try:
+            os.remove(spool.name)
+        except OSError:
+            pass
+
+@functools.lru_cache(maxsize=None)
+def index_page():
+    # The page has no template variables, so read and compress it once
+    with app.open_resource('templates/index.html') as f:
+        html = f.read()
+    return html, gzip.compress(html)
+
 @app.route('/')
 def index():
     """Serve the main page"""
-    return render_template('index.html')
+    if app.debug:
+        # Pick up template edits without restarting the dev server
+        index_page.cache_clear()
+    html, html_gz = index_page()
+    # Werkzeug's quality lookup treats gzip;q=0 as a refusal, unlike a membership test
+    if request.accept_encodings['gzip'] > 0:
+        response = Response(html_gz, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(html, mimetype='text/html')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 @app.route('/api/create_room', methods=['POST'])
 def create_room():
@@ -69,17 +149,21 @@ def send_file():
             return jsonify({'status': 'error', 'message': 'No file provided'}), 400
         
         file = request.files['file']
-        if file.filename == '':
+        # Keep only the final path component so the upload cannot escape TEMP_DIR;
+        # the name itself is what the peer sees, so it is not otherwise rewritten
+        filename = os.path.basename((file.filename or '').replace('\\', '/'))
+        if filename in ('', '.', '..'):
             return jsonify({'status': 'error', 'message': 'No file selected'}), 400
         
-        # Save uploaded file temporarily
-        temp_dir = os.path.join(os.getcwd(), 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_file_path = os.path.join(temp_dir, file.filename)
-        file.save(temp_file_path)
+        # Every file part is spooled into TEMP_DIR while parsing, so it only needs
+        # renaming; it was hashed on the way in, so the sender can skip its own pass
+        temp_file_path = os.path.join(TEMP_DIR, filename)
+        spool = file.stream
+        spool.close()
+        os.replace(spool.name, temp_file_path)
         
-        networking_manager.send_file(temp_file_path)
-        return jsonify({'status': 'success', 'message': f'Sending file: {file.filename}'})
+        networking_manager.send_file(temp_file_path, spool.hasher.hexdigest())
+        return jsonify({'status': 'success', 'message': f'Sending file: {filename}'})
     except Exception as e:
         logger.error(f"Error in send_file: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -104,10 +188,7 @@ def send_message():
 def disconnect():
     """Disconnect the WebRTC connection"""
     try:
-        global networking_manager
-        networking_manager.disconnect()
-        del networking_manager
-        networking_manager = NetworkingManager()
+        networking_manager.reset()
         return jsonify({'status': 'success', 'message': 'Disconnected'})
     except Exception as e:
         logger.error(f"Error in disconnect: {e}")
@@ -126,39 +207,54 @@ def get_status():
 def event_stream():
     """Server-Sent Events endpoint for real-time updates"""
     def generate():
+        subscriber = SSEManager.subscribe()
         try:
             while True:
                 try:
-                    # Wait for events with timeout
-                    event = SSEManager.event_queue.get(timeout=30)
+                    # Wait for events with timeout, then take whatever else is queued
+                    # so a backlog goes out as a single frame
+                    event = subscriber.get(timeout=30)
+                    events = list(event['events'])
+                    while True:
+                        try:
+                            queued = subscriber.get_nowait()
+                        except queue.Empty:
+                            break
+                        for queued_event in queued['events']:
+                            if queued_event['type'] == 'progress' and events and events[-1]['type'] == 'progress':
+                                events[-1] = queued_event
+                            else:
+                                events.append(queued_event)
+                    event = {'type': 'batch', 'events': events, 'timestamp': event['timestamp']}
                     
-                    # Send event to client
-                    event_data = {
-                        'type': event['type'],
-                        'data': event['data'],
-                        'timestamp': event['timestamp']
-                    }
-                    logger.info(f"📡 Sending SSE event to client: {event_data}")
-                    yield f"data: {json.dumps(event_data)}\n\n"
+                    # Send event batch to client
+                    logger.debug("Sending SSE batch of %d events", len(events))
+                    yield sse_frame(event)
                     
                 except queue.Empty:
                     # Send heartbeat to keep connection alive
-                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': time.time()})}\n\n"
+                    yield sse_frame({'type': 'heartbeat', 'timestamp': time.time()})
                     
         except GeneratorExit:
             logger.info("SSE client disconnected")
+        finally:
+            SSEManager.unsubscribe(subscriber)
     
-    return Response(generate(), 
+    response = Response(generate(), 
                    mimetype='text/event-stream',
                    headers={'Cache-Control': 'no-cache',
                            'Connection': 'keep-alive',
-                           'Access-Control-Allow-Origin': '*'})
+                           'Access-Control-Allow-Origin': '*',
+                           'X-Accel-Buffering': 'no'})
+    # Hand frames to the server as they are yielded, without response buffering
+    response.direct_passthrough = True
+    return response
 
 # Static file serving
 @app.route('/static/<path:filename>')
 def static_files(filename):
     """Serve static files"""
-    return send_from_directory('static', filename)
+    return send_from_directory('static', filename, max_age=STATIC_MAX_AGE)
 
 @app.errorhandler(404)
 def not_found(error):
@@ -175,12 +271,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Telekinesis - WebRTC P2P File Transfer Server')
     parser.add_argument('-p', '--port', type=int, default=5000, 
     help='Port to run the server on (default: 5000)')
+    parser.add_argument('--debug', action='store_true',
+    help='Run with the Werkzeug reloader and debugger (development only)')
+    parser.add_argument('--x-sendfile', action='store_true',
+    help='Let a fronting proxy (nginx, Apache) serve file responses via X-Sendfile')
     args = parser.parse_args()
+    app.use_x_sendfile = args.x_sendfile
     
     # Create necessary directories
     os.makedirs('templates', exist_ok=True)
     os.makedirs('static', exist_ok=True)
-    os.makedirs('temp', exist_ok=True)
     
     # Run Flask app
-    app.run(host='0.0.0.0', port=args.port, debug=True, threaded=True)
+    app.run(host='0.0.0.0', port=args.port, debug=args.debug, threaded=True)
@@ -330,6 +330,11 @@ class TelekinesisApp {
                     return;
                 }
                 
+                if (eventData.type === 'batch') {
+                    eventData.events.forEach((batchedEvent) => this.handleEvent(batchedEvent));
+                    return;
+                }
+                
                 this.handleEvent(eventData);
                 
             } catch (error) {